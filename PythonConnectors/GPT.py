@@ -1,27 +1,108 @@
 # AWS Lambda function to interact with OpenAI's GPT-3.5-turbo model & the storing/retreival results in DynamoDB
 
 import json
+import re
+import asyncio
+import base64
+import hmac
 import boto3
+import orjson
 import os
-from datetime import datetime
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 from decimal import Decimal
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import logging
 
 # --- Set up logging ---
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
 
 # --- Setup AWS and OpenAI ---
-dynamodb = boto3.resource("dynamodb")
+# Optional DAX cluster in front of the cache table (the Lambda must run in the cluster's VPC)
+DAX_ENDPOINT = os.environ.get("DAX_ENDPOINT")
+
+
+def connect_dynamodb():
+    if DAX_ENDPOINT:
+        from amazondax import AmazonDaxClient
+        return AmazonDaxClient.resource(endpoint_url=DAX_ENDPOINT)
+    return boto3.session.Session().resource("dynamodb")
+
+
+dynamodb = connect_dynamodb()
 table_name = os.environ.get("GPT_TABLE", "GPT_Transactions")
 table = dynamodb.Table(table_name)
 
+# GSI (PK=entity_type, SK=createdAt) used to list entries newest-first without a Scan
+GPT_INDEX = os.environ.get("GPT_INDEX", "gpt-by-createdAt")
+ENTITY_TYPE = "GPT"
+# Listing only needs the key and timestamp; the stored responses can be large
+LIST_PROJECTION = "GPT, createdAt"
+DEFAULT_LIST_LIMIT = 50
+MAX_LIST_LIMIT = 1000
+
+# --- Optional semantic cache: prompt embeddings matched by cosine similarity ---
+# Table keyed by `keyword` with a GSI (PK=entity_type, SK=createdAt); unset disables the stage
+EMBEDDINGS_TABLE = os.environ.get("EMBEDDINGS_TABLE")
+EMBEDDINGS_INDEX = os.environ.get("EMBEDDINGS_INDEX", "embedding-by-createdAt")
+EMBEDDING_ENTITY_TYPE = "EMBEDDING"
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_THRESHOLD = float(os.environ.get("SEMANTIC_THRESHOLD", "0.92"))
+SEMANTIC_WINDOW = 1000  # Most recent embeddings compared per lookup
+embeddings_table = dynamodb.Table(EMBEDDINGS_TABLE) if EMBEDDINGS_TABLE else None
+if EMBEDDINGS_TABLE:
+    import numpy as np  # Only imported when the semantic cache is enabled
+
+# Parallel scan segments used by purge_all
+PURGE_SEGMENTS = min(8, (os.cpu_count() or 1) * 2)
+
+# Per-worker tables for purge segments and list walks (slot -> Table)
+_SLOT_TABLES = {}
+_SLOT_TABLES_LOCK = threading.Lock()
+
+# Bare integer/decimal replies from GPT
+_NUMBER_RE = re.compile(r"^-?\d+(\.\d+)?$")
+
+# Questions answered per OpenAI call in chat mode
+CHAT_BATCH_SIZE = 8
+# Batches run one after another, so a few of them must fit in API Gateway's 29 s timeout
+MAX_QUESTIONS = CHAT_BATCH_SIZE * 3
+
+# Max in-flight OpenAI requests when generating a list of prompts
+PROMPT_CONCURRENCY = 10
+# One wave per request keeps bulk generation inside API Gateway's 29 s timeout
+MAX_PROMPTS = PROMPT_CONCURRENCY
+
+# --- Warm-container keyword cache (keyword -> (stored_at, record)) ---
+_LOCAL_CACHE = OrderedDict()
+_LOCAL_TTL = 60
+_LOCAL_MAX = 1024
+
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
+# Read once per container instead of on every purge request
+_PURGE_KEY = os.environ.get("PURGE_KEY")
+
+# Stable (>1024 token) system prefix so OpenAI's automatic prompt cache can kick in
+SYSTEM_PROMPT_FILE = os.environ.get(
+    "SYSTEM_PROMPT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.txt")
+)
+with open(SYSTEM_PROMPT_FILE, encoding="utf-8") as f:
+    SYSTEM_PROMPT = f.read()
+
 
 def lambda_handler(event, context):
-    logger.info(f"🚀 Received event: {json.dumps(event)}")
+    # ⏰ EventBridge warmer ping — keep the container warm and skip all work
+    if event.get("source") == "aws.events" and event.get("detail-type") == "Scheduled Event":
+        return {"statusCode": 200, "body": "warm"}
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("🚀 Received event: %s", _dumps(event))
 
     method = event.get("httpMethod", "").upper()
     query = event.get("queryStringParameters", {}) or {}
@@ -31,7 +112,8 @@ def lambda_handler(event, context):
             # 🧹 Handle purge request
             if query.get("purge") == "true":
                 auth_token = query.get("auth", "")
-                if auth_token == os.environ.get("PURGE_KEY"):
+                # Constant-time compare; an unset PURGE_KEY never authorises
+                if _PURGE_KEY and hmac.compare_digest(auth_token.encode(), _PURGE_KEY.encode()):
                     purge_table()
                     return respond(200, {"message": "GPT_Transactions purged."})
                 else:
@@ -39,18 +121,40 @@ def lambda_handler(event, context):
 
             # 📋 Handle list mode via query string
             if query.get("mode") == "list":
-                return list_gpt_entries()
+                if query.get("all") == "true":
+                    # Every stored response in one body would blow Lambda's 6 MB response cap
+                    if query.get("full") == "true":
+                        return respond(400, {"error": "'full=true' cannot be combined with 'all=true'; page with 'nextToken' instead."})
+                    return list_all_gpt_entries()
+                return list_gpt_entries(query)
 
             # 🤖 Normal keyword/gptInput request
             return get_or_generate(event)
 
         elif method == "POST":
-            return generate_and_store(event)
+            body = json.loads(event.get("body") or "{}")
+            if not isinstance(body, dict):
+                logger.warning("⚠️ POST body is not a JSON object")
+                return respond(400, {"error": "POST body must be a JSON object"})
+            # 💬 Several short questions answered in as few OpenAI calls as possible
+            if body.get("mode") == "chat":
+                return chat_direct(body)
+            # 📚 Several keyword/prompt pairs generated concurrently
+            if isinstance(body.get("prompts"), list):
+                return generate_many(body)
+            return generate_and_store(body)
 
         else:
             logger.warning(f"❌ Unsupported HTTP method: {method}")
             return respond(405, {"error": f"Unsupported method: {method}"})
 
+    # Malformed client input: answer 400 without paying for a traceback
+    except json.JSONDecodeError as e:
+        logger.warning(f"⚠️ Invalid JSON body: {e}")
+        return respond(400, {"error": f"Invalid JSON body: {str(e)}"})
+    except KeyError as e:
+        logger.warning(f"⚠️ Missing field: {e}")
+        return respond(400, {"error": f"Missing field: {str(e)}"})
     except Exception as e:
         logger.exception("🔥 Unhandled exception in lambda_handler")
         return respond(500, {"error": str(e)})
@@ -71,12 +175,20 @@ def get_or_generate(event):
         logger.warning("⚠️ Missing 'keyword'")
         return respond(400, {"error": "Missing 'keyword' in query params."})
 
+    # --- Check warm-container cache ---
+    cached = local_cache_get(keyword)
+    if cached:
+        logger.info(f"⚡ Local cache hit for keyword: {keyword}")
+        return respond(200, cached)
+
     # --- Check DynamoDB Cache ---
     try:
-        result = table.get_item(Key={"GPT": keyword})
+        # Eventually consistent on purpose: strongly consistent reads bypass the DAX item cache
+        result = table.get_item(Key={"GPT": keyword}, ConsistentRead=False)
         item = result.get("Item")
         if item:
             logger.info(f"✅ Cache hit for keyword: {keyword}")
+            local_cache_put(keyword, item)
             return respond(200, item)
         elif cache_only:
             logger.info("🚫 Cache miss and 'cacheOnly' is true — skipping OpenAI")
@@ -91,37 +203,59 @@ def get_or_generate(event):
         logger.warning("⚠️ Missing 'gptInput' for OpenAI fallback")
         return respond(400, {"error": "Missing 'gptInput' for OpenAI fallback"})
 
+    # --- Semantic cache: serve a stored answer to a near-identical prompt ---
+    embedding = None
+    if embeddings_table is not None:
+        try:
+            embedding = embed_prompt(gpt_input)
+            match = semantic_lookup(embedding)
+            if match:
+                logger.info(f"🧲 Semantic cache hit for keyword: {keyword} -> {match['GPT']}")
+                # Repeats of this keyword skip the embeddings call and index query
+                local_cache_put(keyword, match)
+                return respond(200, match)
+        except Exception:
+            # The semantic stage is best-effort; fall through to OpenAI
+            logger.exception("🧲 Semantic cache lookup failed")
+
     try:
         gpt_result = client.chat.completions.create(
             model="gpt-3.5-turbo",
             temperature=0.7,
-            messages=[{"role": "user", "content": gpt_input}]
+            messages=build_messages(gpt_input)
         )
-        logger.info(f"📤 OpenAI Payload: {json.dumps(gpt_result, indent=2)}") 
+        log_prompt_cache(gpt_result)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 OpenAI Payload: %s", gpt_result.model_dump_json())
 
         message = normalize_gpt_response(gpt_result.choices[0].message.content.strip())
 
-        logger.info(f"🤖 OpenAI response received: {message[:200]}...")
+        logger.info("🤖 OpenAI response received: %.200s...", message)
 
-        record = {
-            "GPT": keyword,
+        # A refusal must not be cached, or it sticks to this keyword for good
+        if is_error_reply(message):
+            logger.warning(f"🙅 OpenAI declined keyword '{keyword}': {message['error']}")
+            return respond(502, {"error": f"OpenAI declined: {message['error']}", "request": gpt_input})
+
+        record = store_first_writer(keyword, {
             "response": message,
             "promo": promo,
             "keyword": keyword,
             "prompt": gpt_input,
-            "createdAt": int(datetime.utcnow().timestamp())
-        }
-
-        table.put_item(Item=record)
+            "entity_type": ENTITY_TYPE,
+            "createdAt": int(time.time())
+        })
+        local_cache_put(keyword, record)
         logger.info(f"💾 Stored OpenAI response in DynamoDB under key: {keyword}")
+        if embedding is not None:
+            store_embedding(keyword, embedding, record["createdAt"])
         return respond(200, record)
 
     except Exception as e:
         logger.exception("🧠 OpenAI request failed")
         return respond(502, {"error": f"OpenAI error: {str(e)}", "request": gpt_input})
 
-def generate_and_store(event):
-    body = json.loads(event.get("body", "{}"))
+def generate_and_store(body):
     keyword = body.get("keyword", "").strip().lower()
     promo = body.get("promo", "").strip()
     gpt_prompt = body.get("prompt", "").strip()  # 👈 Pull the actual prompt
@@ -130,17 +264,23 @@ def generate_and_store(event):
         logger.warning("⚠️ Missing 'keyword' or 'prompt' in POST body")
         return respond(400, {"error": "Missing 'keyword' or 'prompt' in POST body"})
 
-    logger.info(f"🔍 Body: {json.dumps(body)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("🔍 Body: %s", _dumps(body))
 
     try:
         gpt_result = client.chat.completions.create(
             model="gpt-3.5-turbo",
             temperature=0.7,
-            messages=[{"role": "user", "content": gpt_prompt}]  # 👈 Corrected
+            messages=build_messages(gpt_prompt)
         )
+        log_prompt_cache(gpt_result)
 
         message = normalize_gpt_response(gpt_result.choices[0].message.content.strip())
-        logger.info(f"🤖 OpenAI returned response: {message[:200]}...")
+        logger.info("🤖 OpenAI returned response: %.200s...", message)
+
+        if is_error_reply(message):
+            logger.warning(f"🙅 OpenAI declined keyword '{keyword}': {message['error']}")
+            return respond(502, {"error": f"OpenAI declined: {message['error']}", "input": gpt_prompt})
 
         record = {
             "GPT": keyword,
@@ -148,10 +288,12 @@ def generate_and_store(event):
             "promo": promo,
             "keyword": keyword,
             "prompt": gpt_prompt,  # Keep for traceability
-            "createdAt": int(datetime.utcnow().timestamp())
+            "entity_type": ENTITY_TYPE,
+            "createdAt": int(time.time())
         }
 
         table.put_item(Item=record)
+        local_cache_put(keyword, record)
         logger.info(f"💾 Stored GPT result under keyword: {keyword}")
         return respond(200, record)
 
@@ -160,68 +302,381 @@ def generate_and_store(event):
         return respond(502, {"error": f"OpenAI error: {str(e)}", "input": gpt_prompt})
 
 
-# Custom encoder for Decimal
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            if obj % 1 == 0:
-                return int(obj)
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+def generate_many(body):
+    if len(body["prompts"]) > MAX_PROMPTS:
+        return respond(400, {"error": f"At most {MAX_PROMPTS} entries in 'prompts' per request."})
+
+    entries = []
+    for entry in body["prompts"]:
+        if not isinstance(entry, dict):
+            return respond(400, {"error": "Each entry in 'prompts' must be an object"})
+        keyword, gpt_prompt, promo = entry.get("keyword"), entry.get("prompt"), entry.get("promo", "")
+        # Reject nulls and non-strings rather than str()-ing them into "None"
+        if not all(isinstance(v, str) for v in (keyword, gpt_prompt, promo)):
+            return respond(400, {"error": "'keyword', 'prompt' and 'promo' in 'prompts' must be strings"})
+        keyword, gpt_prompt = keyword.strip().lower(), gpt_prompt.strip()
+        if not keyword or not gpt_prompt:
+            return respond(400, {"error": "Each entry in 'prompts' needs a 'keyword' and a 'prompt'"})
+        entries.append({"keyword": keyword, "prompt": gpt_prompt, "promo": promo.strip()})
+
+    if not entries:
+        return respond(400, {"error": "'prompts' must not be empty"})
+
+    logger.info(f"📚 Generating {len(entries)} prompt(s) concurrently")
+    results = asyncio.run(generate_concurrently([e["prompt"] for e in entries]))
+
+    records, errors = [], []
+    created_at = int(time.time())
+    with table.batch_writer(overwrite_by_pkeys=["GPT"]) as batch:
+        for entry, result in zip(entries, results):
+            if isinstance(result, Exception):
+                logger.warning(f"⚠️ OpenAI failed for keyword '{entry['keyword']}': {result}")
+                errors.append({"keyword": entry["keyword"], "error": f"OpenAI error: {str(result)}"})
+                continue
+            message = normalize_gpt_response(result.choices[0].message.content.strip())
+            if is_error_reply(message):
+                logger.warning(f"🙅 OpenAI declined keyword '{entry['keyword']}': {message['error']}")
+                errors.append({"keyword": entry["keyword"], "error": f"OpenAI declined: {message['error']}"})
+                continue
+            record = {
+                "GPT": entry["keyword"],
+                "response": message,
+                "promo": entry["promo"],
+                "keyword": entry["keyword"],
+                "prompt": entry["prompt"],
+                "entity_type": ENTITY_TYPE,
+                "createdAt": created_at
+            }
+            batch.put_item(Item=record)
+            local_cache_put(entry["keyword"], record)
+            records.append(record)
+
+    logger.info(f"💾 Stored {len(records)} GPT result(s), {len(errors)} failed")
+    return respond(200 if records else 502, {"results": records, "errors": errors})
+
+async def generate_concurrently(prompts):
+    # Overlap the OpenAI round trips; the semaphore keeps us under the RPM limit.
+    # The async client is scoped to this event loop since asyncio.run closes it afterwards.
+    semaphore = asyncio.Semaphore(PROMPT_CONCURRENCY)
+    async with AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY")) as aclient:
+        async def complete(prompt):
+            async with semaphore:
+                gpt_result = await aclient.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    temperature=0.7,
+                    messages=build_messages(prompt)
+                )
+                log_prompt_cache(gpt_result)
+                return gpt_result
+
+        return await asyncio.gather(*(complete(p) for p in prompts), return_exceptions=True)
+
+def chat_direct(body):
+    questions = body.get("questions")
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) and q.strip() for q in questions):
+        logger.warning("⚠️ Missing or invalid 'questions' in chat body")
+        return respond(400, {"error": "'questions' must be a non-empty list of strings"})
+    if len(questions) > MAX_QUESTIONS:
+        return respond(400, {"error": f"At most {MAX_QUESTIONS} questions per request."})
+
+    questions = [q.strip() for q in questions]
+    logger.info(f"💬 Chat request with {len(questions)} question(s)")
+
+    try:
+        answers = []
+        for start in range(0, len(questions), CHAT_BATCH_SIZE):
+            batch = questions[start:start + CHAT_BATCH_SIZE]
+            parsed = answer_batch(batch)
+            if is_error_reply(parsed):
+                logger.warning(f"🙅 OpenAI declined chat batch: {parsed['error']}")
+                return respond(502, {"error": f"OpenAI declined: {parsed['error']}"})
+            answers.extend(parsed.get(f"Q{i}") for i in range(len(batch)))
+    except Exception as e:
+        logger.exception("🧠 OpenAI chat request failed")
+        return respond(502, {"error": f"OpenAI error: {str(e)}"})
+
+    return respond(200, {"answers": [{"question": q, "answer": a} for q, a in zip(questions, answers)]})
+
+def answer_batch(batch):
+    # One completion answers the whole batch; answers come back keyed by their Qi label
+    content = "Answer each question below. Return a JSON object keyed by label (Q0, Q1, ...).\n" + "\n".join(
+        f"Q{i}: {q}" for i, q in enumerate(batch)
+    )
+    gpt_result = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        temperature=0.7,
+        messages=build_messages(content)
+    )
+    log_prompt_cache(gpt_result)
+
+    parsed = normalize_gpt_response(gpt_result.choices[0].message.content.strip())
+    if not isinstance(parsed, dict):
+        logger.warning("⚠️ Chat batch reply was not a JSON object")
+        parsed = {}
+    return parsed
+
+
+# DynamoDB numbers come back as Decimal; only called for types json can't encode natively
+def _decimal_default(obj):
+    if isinstance(obj, Decimal):
+        if obj % 1 == 0:
+            return int(obj)
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _dumps(obj):
+    return orjson.dumps(obj, default=_decimal_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*"
+}
 
 def respond(status, body):
     return {
         "statusCode": status,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*"
-        },
-        "body": json.dumps(body, cls=DecimalEncoder)
+        "headers": _HEADERS,
+        "body": _dumps(body)
     }
 
 
 ### Helper functions ###
 def purge_table():
-    deleted = 0
-    scan = table.scan(ProjectionExpression='GPT')
-    with table.batch_writer() as batch:
-        for item in scan['Items']:
-            batch.delete_item(Key={'GPT': item['GPT']})
-            deleted += 1
+    deleted = purge_all(table_name, "GPT")
+    _LOCAL_CACHE.clear()
     logger.info(f"✅ Deleted {deleted} items from GPT_Transactions")
+    if EMBEDDINGS_TABLE:
+        # Otherwise the semantic window keeps matching keywords that no longer exist
+        purged = purge_all(EMBEDDINGS_TABLE, "keyword")
+        logger.info(f"✅ Deleted {purged} items from {EMBEDDINGS_TABLE}")
     return deleted
 
-def list_gpt_entries():
-    try:
-        scan = table.scan()
-        items = scan.get("Items", [])
-        sorted_items = sorted(items, key=lambda x: x.get("createdAt", 0), reverse=True)
+def purge_all(name, key):
+    # Each segment gets its own worker, scan pages and batch writer
+    with ThreadPoolExecutor(max_workers=PURGE_SEGMENTS) as pool:
+        return sum(pool.map(lambda segment: purge_segment(name, key, segment), range(PURGE_SEGMENTS)))
+
+def purge_segment(name, key, segment):
+    segment_table = thread_table(("purge", name, segment), name)
+    scan_args = {
+        "Segment": segment,
+        "TotalSegments": PURGE_SEGMENTS,
+        "ProjectionExpression": "#k",
+        "ExpressionAttributeNames": {"#k": key},
+        "ConsistentRead": False,
+    }
+    deleted = 0
+    with segment_table.batch_writer() as batch:
+        while True:
+            scan = segment_table.scan(**scan_args)
+            for item in scan.get("Items", []):
+                batch.delete_item(Key={key: item[key]})
+                deleted += 1
+            if "LastEvaluatedKey" not in scan:
+                break
+            scan_args["ExclusiveStartKey"] = scan["LastEvaluatedKey"]
+    return deleted
 
-        return respond(200, {"gptEntries": sorted_items})
+def list_gpt_entries(params):
+    try:
+        query_args = {
+            "IndexName": GPT_INDEX,
+            "KeyConditionExpression": Key("entity_type").eq(ENTITY_TYPE),
+            "ScanIndexForward": False,  # Newest first, straight from the sort key
+            "Limit": max(1, min(int(params.get("limit", DEFAULT_LIST_LIMIT)), MAX_LIST_LIMIT)),
+        }
+        if params.get("full") != "true":
+            query_args["ProjectionExpression"] = LIST_PROJECTION
+        if params.get("nextToken"):
+            query_args["ExclusiveStartKey"] = decode_token(params["nextToken"])
+
+        result = table.query(**query_args)
+        return respond(200, {
+            "gptEntries": result.get("Items", []),
+            "nextToken": encode_token(result.get("LastEvaluatedKey"))
+        })
+    except ValueError as e:
+        return respond(400, {"error": f"Invalid list parameters: {str(e)}"})
     except Exception as e:
         logger.exception("🛑 Failed to list GPT entries")
         return respond(500, {"error": str(e)})
 
+def list_all_gpt_entries():
+    # Walk the index from both ends at once and stop where the two walks meet
+    seen = {True: set(), False: set()}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def walk(forward):
+        walk_table = thread_table(("walk", forward))
+        query_args = {
+            "IndexName": GPT_INDEX,
+            "KeyConditionExpression": Key("entity_type").eq(ENTITY_TYPE),
+            "ScanIndexForward": forward,
+            "ProjectionExpression": LIST_PROJECTION,
+        }
+        items = []
+        while not done.is_set():
+            page = walk_table.query(**query_args)
+            for item in page.get("Items", []):
+                with lock:
+                    if item["GPT"] in seen[not forward]:
+                        done.set()
+                        return items
+                    seen[forward].add(item["GPT"])
+                items.append(item)
+            if "LastEvaluatedKey" not in page:
+                done.set()
+                break
+            query_args["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+        return items
+
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            oldest_first, newest_first = pool.map(walk, (True, False))
+
+        # newest_first is the head of the list, oldest_first (reversed) the tail
+        entries = newest_first + [i for i in reversed(oldest_first) if i["GPT"] not in seen[False]]
+        return respond(200, {"gptEntries": entries})
+    except Exception as e:
+        logger.exception("🛑 Failed to list all GPT entries")
+        return respond(500, {"error": str(e)})
+
+def thread_table(slot, name=table_name):
+    # boto3 resources are not thread-safe, so each worker slot gets its own,
+    # built once per container and reused so warm calls keep their connections
+    with _SLOT_TABLES_LOCK:
+        if slot not in _SLOT_TABLES:
+            _SLOT_TABLES[slot] = connect_dynamodb().Table(name)
+        return _SLOT_TABLES[slot]
+
+def encode_token(last_key):
+    if not last_key:
+        return None
+    return base64.urlsafe_b64encode(_dumps(last_key).encode()).decode()
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("malformed nextToken") from e
+
+def store_first_writer(keyword, fields):
+    # Single conditional write: the first concurrent miss wins, later ones get its record back
+    names = {f"#f{i}": k for i, k in enumerate(fields)}
+    values = {f":f{i}": v for i, v in enumerate(fields.values())}
+    try:
+        result = table.update_item(
+            Key={"GPT": keyword},
+            UpdateExpression="SET " + ", ".join(f"#f{i} = :f{i}" for i in range(len(fields))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ConditionExpression="attribute_not_exists(GPT)",
+            ReturnValues="ALL_NEW"
+        )
+        return result["Attributes"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.info(f"🏁 Concurrent request already stored keyword: {keyword}")
+        return table.get_item(Key={"GPT": keyword}, ConsistentRead=True)["Item"]
+
+def build_messages(user_content):
+    # System prompt always goes first so every request shares the same cacheable prefix
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
+def log_prompt_cache(gpt_result):
+    usage = getattr(gpt_result, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    if usage:
+        logger.info(f"🧾 Prompt tokens: {usage.prompt_tokens}, cached: {cached}")
+
+def embed_prompt(text):
+    result = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(result.data[0].embedding, dtype=np.float32)
+    # Stored unit-length so a dot product is the cosine similarity
+    return vector / np.linalg.norm(vector)
+
+def semantic_lookup(embedding):
+    query_args = {
+        "IndexName": EMBEDDINGS_INDEX,
+        "KeyConditionExpression": Key("entity_type").eq(EMBEDDING_ENTITY_TYPE),
+        "ScanIndexForward": False,
+        "ProjectionExpression": "keyword, embedding",
+    }
+    keywords, vectors = [], []
+    while len(keywords) < SEMANTIC_WINDOW:
+        query_args["Limit"] = SEMANTIC_WINDOW - len(keywords)
+        page = embeddings_table.query(**query_args)
+        for item in page.get("Items", []):
+            keywords.append(item["keyword"])
+            vectors.append(bytes(item["embedding"]))
+        if "LastEvaluatedKey" not in page:
+            break
+        query_args["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    if not keywords:
+        return None
+
+    scores = np.frombuffer(b"".join(vectors), dtype=np.float32).reshape(len(vectors), -1) @ embedding
+    best = int(np.argmax(scores))
+    logger.info(f"🧲 Closest prompt: {keywords[best]} (similarity {scores[best]:.3f})")
+    if scores[best] < SEMANTIC_THRESHOLD:
+        return None
+    return table.get_item(Key={"GPT": keywords[best]}, ConsistentRead=False).get("Item")
+
+def store_embedding(keyword, embedding, created_at):
+    try:
+        embeddings_table.put_item(Item={
+            "keyword": keyword,
+            "embedding": embedding.tobytes(),
+            "entity_type": EMBEDDING_ENTITY_TYPE,
+            "createdAt": created_at
+        })
+    except Exception:
+        logger.exception("🧲 Failed to store prompt embedding")
+
+def is_error_reply(message):
+    # The system prompt asks for {"error": "<reason>"} when a request can't be answered
+    return isinstance(message, dict) and list(message) == ["error"]
+
+def local_cache_get(keyword):
+    entry = _LOCAL_CACHE.get(keyword)
+    if not entry:
+        return None
+    stored_at, record = entry
+    if time.monotonic() - stored_at >= _LOCAL_TTL:
+        del _LOCAL_CACHE[keyword]
+        return None
+    _LOCAL_CACHE.move_to_end(keyword)
+    return record
+
+def local_cache_put(keyword, record):
+    _LOCAL_CACHE[keyword] = (time.monotonic(), record)
+    _LOCAL_CACHE.move_to_end(keyword)
+    if len(_LOCAL_CACHE) > _LOCAL_MAX:
+        _LOCAL_CACHE.popitem(last=False)
+
 def normalize_gpt_response(raw_response):
     raw = raw_response.strip()
 
-    # Try to unwrap JSON-encoded strings repeatedly
-    while True:
+    # Unwrap JSON-encoded strings repeatedly — only text that can start a string/array/object is parsed
+    while raw and raw[0] in '"[{':
         try:
             parsed = json.loads(raw)
-            if isinstance(parsed, str):
-                raw = parsed.strip()
-                continue
-            return parsed  # Could be dict, list, number, etc.
         except json.JSONDecodeError:
             break
-
-    # Try parsing as number
-    try:
-        if '.' in raw:
-            return float(raw)
-        return int(raw)
-    except ValueError:
-        pass
+        if isinstance(parsed, str):
+            raw = parsed.strip()
+            continue
+        return parsed  # dict or list
+
+    # Plain numbers are matched up front instead of by trial parsing
+    if _NUMBER_RE.match(raw):
+        return float(raw) if '.' in raw else int(raw)
 
     return raw  # Final fallback
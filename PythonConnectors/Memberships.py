@@ -4,7 +4,8 @@
 import json
 import boto3
 import os
-from datetime import datetime
+import time
+from botocore.exceptions import ClientError
 
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table(os.environ.get("MEMBERSHIP_TABLE", "Memberships"))
@@ -38,10 +39,6 @@ def create_membership(event):
 
     email = body["email"].lower().strip()
 
-    existing = table.get_item(Key={"email": email}).get("Item")
-    if existing:
-        return respond(409, {"error": "Membership already exists"})
-
     item = {
         "email": email,
         "gptLimit": int(body["gptLimit"]),
@@ -50,10 +47,16 @@ def create_membership(event):
         "subscription_end": int(body["subscription_end"]),
         "tier": body["tier"],
         "payment_freq": body["payment_freq"],
-        "lastUpdated": int(datetime.utcnow().timestamp())
+        "lastUpdated": int(time.time())
     }
 
-    table.put_item(Item=item)
+    # Conditional put: existence check and write in one atomic round trip
+    try:
+        table.put_item(Item=item, ConditionExpression="attribute_not_exists(email)")
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return respond(409, {"error": "Membership already exists"})
+        raise
     return respond(201, {"message": "Membership created", "data": item})
 
 # GET: Retrieve membership
@@ -85,15 +88,17 @@ def update_membership(event):
     if not update_fields:
         return respond(400, {"error": "No updatable fields provided"})
 
-    update_expr = "SET " + ", ".join(f"{k}=:{k}" for k in update_fields)
-    update_expr += ", lastUpdated = :lastUpdated"
-
+    # Attribute names go through #placeholders so reserved words can't break the expression
+    update_expr = "SET " + ", ".join(f"#{k} = :{k}" for k in update_fields) + ", #lastUpdated = :lastUpdated"
+    expr_names = {f"#{k}": k for k in update_fields}
+    expr_names["#lastUpdated"] = "lastUpdated"
     expr_vals = {f":{k}": v for k, v in update_fields.items()}
-    expr_vals[":lastUpdated"] = int(datetime.utcnow().timestamp())
+    expr_vals[":lastUpdated"] = int(time.time())
 
     table.update_item(
         Key={"email": email},
         UpdateExpression=update_expr,
+        ExpressionAttributeNames=expr_names,
         ExpressionAttributeValues=expr_vals
     )
 
@@ -108,13 +113,16 @@ def delete_membership(event):
     table.delete_item(Key={"email": email})
     return respond(200, {"message": "Membership deleted", "email": email})
 
+# Static headers shared by every response (API Gateway never mutates them)
+_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*"
+}
+
 # Utility response wrapper
 def respond(status, body):
     return {
         "statusCode": status,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*"
-        },
+        "headers": _HEADERS,
         "body": json.dumps(body)
     }
@@ -1,19 +1,90 @@
-import json
+import base64
 import boto3
+import hmac
+import orjson
 import os
-from decimal import Decimal
-from datetime import datetime
+import time
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.table import BatchWriter
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
-# Initialize DynamoDB
-dynamodb = boto3.resource("dynamodb")
-table = dynamodb.Table(os.environ.get("USER_TABLE", "User"))
+# Initialize DynamoDB (low-level client: no Resource layer per call)
+TABLE_NAME = os.environ.get("USER_TABLE", "User")
+ddb = boto3.client(
+    "dynamodb",
+    config=Config(
+        tcp_keepalive=True,  # Keep the idle socket alive between warm invocations
+        connect_timeout=1,
+        read_timeout=3,
+        retries={"max_attempts": 3, "mode": "adaptive"}
+    )
+)
+
+# Page size for get_all_users when the caller doesn't pass `limit`, and the hard cap
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Attributes get_all_users returns by default, and those a caller may ask for via `fields`
+LIST_FIELDS = ("email", "firstName", "lastName", "business", "createdAt")
+_LISTABLE_FIELDS = frozenset(LIST_FIELDS + ("promo", "updatedAt"))
+
+# BatchGetItem accepts at most 100 keys; unprocessed keys are retried with backoff
+BATCH_GET_LIMIT = 100
+BATCH_GET_RETRIES = 5
+
+# DynamoDB error codes surfaced with a specific HTTP status (anything else is a 500)
+_CLIENT_ERROR_STATUS = {
+    "ConditionalCheckFailedException": 409,
+    "TransactionCanceledException": 409,
+    "ValidationException": 400,
+    "ProvisionedThroughputExceededException": 503,
+    "ThrottlingException": 503,
+    "RequestLimitExceeded": 503,
+}
+RETRY_AFTER_SECONDS = "1"
+
+# Shared secret required for DELETE ?purge=true (unset disables purging)
+_PURGE_KEY = os.environ.get("PURGE_KEY")
+
+# Request body fields, fixed at import
+_REQUIRED = ("email", "firstName", "lastName", "business")
+_OPTIONAL = ("promo",)
+_UPDATE_FIELDS = ("firstName", "lastName", "business")
+
+
+def _update_template(fields):
+    clauses = [f"#{k} = :{k}" for k in fields] + ["#updatedAt = :updatedAt"]
+    names = {f"#{k}": k for k in fields}
+    names["#updatedAt"] = "updatedAt"
+    return "SET " + ", ".join(clauses), names
+
+
+# Every subset of updatable fields -> (UpdateExpression, ExpressionAttributeNames), built once
+_UPDATE_TEMPLATES = {
+    frozenset(subset): _update_template(subset)
+    for size in range(len(_UPDATE_FIELDS) + 1)
+    for subset in combinations(_UPDATE_FIELDS, size)
+}
+
+# Parallel scan segments used by purge_users
+PURGE_SEGMENTS = min(8, (os.cpu_count() or 1) * 2)
+
+# Warm-up during INIT: resolves credentials, loads the service model and opens the TLS connection
+# before the first billed invocation. Failures (e.g. no DescribeTable permission) only skip the warm-up.
+try:
+    ddb.describe_table(TableName=TABLE_NAME)
+except (BotoCoreError, ClientError):
+    pass
 
 def lambda_handler(event, context):
     method = event.get("httpMethod", "").upper()
     try:
         if method == "GET":
             params = event.get("queryStringParameters", {})
-            if params and "email" in params:
+            if params and "emails" in params:
+                return get_users_batch(event)
+            elif params and "email" in params:
                 return get_user(event)
             else:
                 return get_all_users(event)
@@ -22,153 +93,311 @@ def lambda_handler(event, context):
         elif method == "PUT" or method == "PATCH":
             return update_user(event)
         elif method == "DELETE":
+            params = event.get("queryStringParameters") or {}
+            if params.get("purge") == "true":
+                auth_token = params.get("auth", "")
+                if _PURGE_KEY and hmac.compare_digest(auth_token.encode(), _PURGE_KEY.encode()):
+                    return purge_users()
+                return respond(403, {"error": "Unauthorized purge attempt."})
             return delete_user(event)
-        elif method == "DELETE" and event.get("queryStringParameters", {}).get("purge") == "true":
-            return purge_users()
         else:
             return respond(405, {"error": f"Unsupported method: {method}"})
+    except ClientError as e:
+        return client_error_response(e)
+    except orjson.JSONDecodeError as e:
+        return respond(400, {"error": f"Invalid JSON body: {str(e)}"})
     except Exception as e:
         return respond(500, {"error": str(e)})
 
 def get_user(event):
     params = event.get("queryStringParameters", {})
-    email = params.get("email", "").strip().lower()
+    email = norm_email(params.get("email"))
 
     if not email:
         return respond(400, {"error": "Missing 'email' in query params."})
 
     try:
-        result = table.get_item(Key={"email": email})
+        result = ddb.get_item(TableName=TABLE_NAME, Key={"email": {"S": email}})
         item = result.get("Item")
         if not item:
             return respond(404, {"error": f"User with email '{email}' not found."})
-        return respond(200, item)
-    except Exception as e:
+        return respond(200, from_item(item))
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB error: {str(e)}"})
     
-def get_all_users(event):
+def get_users_batch(event):
+    params = event.get("queryStringParameters") or {}
+    # Normalise and dedupe while keeping the caller's order
+    emails = list(dict.fromkeys(e for e in map(norm_email, params.get("emails", "").split(",")) if e))
+
+    if not emails:
+        return respond(400, {"error": "Missing 'emails' in query params."})
+    if len(emails) > BATCH_GET_LIMIT:
+        return respond(400, {"error": f"At most {BATCH_GET_LIMIT} emails per request."})
+
     try:
-        result = table.scan()
-        items = result.get("Items", [])
+        users = []
+        request = {TABLE_NAME: {"Keys": [{"email": {"S": e}} for e in emails]}}
+        for attempt in range(BATCH_GET_RETRIES):
+            result = ddb.batch_get_item(RequestItems=request)
+            users.extend(from_item(item) for item in result.get("Responses", {}).get(TABLE_NAME, []))
+            request = result.get("UnprocessedKeys") or {}
+            if not request:
+                break
+            # No point backing off when no retry follows
+            if attempt < BATCH_GET_RETRIES - 1:
+                time.sleep(min(0.05 * 2 ** attempt, 1))
 
-        # Remove Decimal issues for JSON serialization
-        for item in items:
-            if "createdAt" in item:
-                item["createdAt"] = int(item["createdAt"])
+        unprocessed = [k["email"]["S"] for k in request.get(TABLE_NAME, {}).get("Keys", [])]
+        found = {u["email"] for u in users}
+        missing = [e for e in emails if e not in found and e not in unprocessed]
+        return respond(200, {"users": users, "missing": missing, "unprocessed": unprocessed})
+    except BotoCoreError as e:
+        return respond(500, {"error": f"DynamoDB error: {str(e)}"})
 
-        return respond(200, {"users": items})
-    except Exception as e:
+def get_all_users(event):
+    params = event.get("queryStringParameters") or {}
+    try:
+        scan_args = {
+            "TableName": TABLE_NAME,
+            # Bounded so no single call buffers and serialises an unbounded page
+            "Limit": max(1, min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)),
+        }
+        scan_args.update(projection(params.get("fields")))
+        if params.get("nextToken"):
+            scan_args["ExclusiveStartKey"] = decode_token(params["nextToken"])
+    except ValueError as e:
+        return respond(400, {"error": f"Invalid list parameters: {str(e)}"})
+
+    try:
+        # One page per call: DynamoDB caps a scan response at 1 MB anyway
+        result = ddb.scan(**scan_args)
+        items = [from_item(item) for item in result.get("Items", [])]
+        return respond(200, {"users": items, "nextToken": encode_token(result.get("LastEvaluatedKey"))})
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB scan error: {str(e)}"})  
 
 def create_user(event):
-    body = json.loads(event.get("body", "{}"))
-    email = body.get("email", "").strip().lower()
-    first_name = body.get("firstName", "").strip()
-    last_name = body.get("lastName", "").strip()
-    business = body.get("business", "").strip()
-    promo = body.get("promo", "").strip()
+    body = orjson.loads(event.get("body") or "{}")
 
-    if not email or not first_name or not last_name or not business:
-        return respond(400, {"error": "Missing required fields: 'email', 'firstName', 'lastName', 'business'."})
+    # Validate and build the record in one pass over the field tuples
+    record = {}
+    for key in _REQUIRED:
+        value = body.get(key)
+        if not isinstance(value, str) or not (value := value.strip()):
+            return respond(400, {"error": f"Missing required field '{key}'."})
+        record[key] = norm_email(value) if key == "email" else value
+    for key in _OPTIONAL:
+        value = body.get(key)
+        record[key] = value.strip() if isinstance(value, str) else ""
+    record["createdAt"] = int(time.time())
 
     try:
-        record = {
-            "email": email,
-            "firstName": first_name,
-            "lastName": last_name,
-            "business": business,
-            "promo": promo,
-            "createdAt": int(datetime.utcnow().timestamp())
-        }
-        table.put_item(Item=record)
+        ddb.put_item(TableName=TABLE_NAME, Item=to_item(record))
         return respond(201, {"message": "User created successfully.", "user": record})
-    except Exception as e:
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB error: {str(e)}"})
 
 def update_user(event):
-    body = json.loads(event.get("body", "{}"))
-    current_email = body.get("email", "").strip().lower()
-    new_email = body.get("newEmail", "").strip().lower()  # New email if provided
+    body = orjson.loads(event.get("body") or "{}")
+    current_email = norm_email(body.get("email"))
+    new_email = norm_email(body.get("newEmail"))  # New email if provided
 
     if not current_email:
         return respond(400, {"error": "Missing 'email' in request body."})
 
     update_fields = {}
-    for key in ["firstName", "lastName", "business"]:
-        if key in body:
-            update_fields[key] = body[key].strip()
+    for key in _UPDATE_FIELDS:
+        value = body.get(key)
+        if isinstance(value, str):
+            update_fields[key] = value.strip()
 
     if not update_fields and not new_email:
         return respond(400, {"error": "No update fields or newEmail provided."})
 
-    try:
-        # Fetch current item
-        result = table.get_item(Key={"email": current_email})
-        item = result.get("Item")
-        if not item:
-            return respond(404, {"error": f"User with email '{current_email}' not found."})
-
-        # Update fields in memory
-        item.update(update_fields)
-        item["updatedAt"] = int(datetime.utcnow().timestamp())
+    updated_at = int(time.time())
 
-        # If newEmail is provided, copy to new key and delete old
-        if new_email:
+    try:
+        # If newEmail is provided, move the record to the new key atomically
+        if new_email and new_email != current_email:
+            result = ddb.get_item(TableName=TABLE_NAME, Key={"email": {"S": current_email}})
+            item = result.get("Item")
+            if not item:
+                return respond(404, {"error": f"User with email '{current_email}' not found."})
+            item = from_item(item)
+            item.update(update_fields)
+            item["updatedAt"] = updated_at
             item["email"] = new_email
-            table.put_item(Item=item)
-            table.delete_item(Key={"email": current_email})
+
+            try:
+                ddb.transact_write_items(TransactItems=[
+                    {"Put": {
+                        "TableName": TABLE_NAME,
+                        "Item": to_item(item),
+                        "ConditionExpression": "attribute_not_exists(email)"
+                    }},
+                    {"Delete": {
+                        "TableName": TABLE_NAME,
+                        "Key": {"email": {"S": current_email}},
+                        "ConditionExpression": "attribute_exists(email)"
+                    }}
+                ])
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "TransactionCanceledException":
+                    raise
+                reasons = [r.get("Code") for r in e.response.get("CancellationReasons", [])]
+                if reasons[:1] == ["ConditionalCheckFailed"]:
+                    return respond(409, {"error": f"User with email '{new_email}' already exists."})
+                if reasons[1:2] == ["ConditionalCheckFailed"]:
+                    return respond(404, {"error": f"User with email '{current_email}' not found."})
+                raise
             return respond(200, {"message": f"Email updated to '{new_email}' and user updated.", "user": item})
 
-        # If email isn't changing, just update in place
-        update_expression = "SET " + ", ".join([f"{k} = :{k}" for k in update_fields])
-        expression_values = {f":{k}": v for k, v in update_fields.items()}
-        expression_values[":updatedAt"] = item["updatedAt"]
-        update_expression += ", updatedAt = :updatedAt"
+        # If email isn't changing, update in place in a single round trip
+        update_expression, expression_names = _UPDATE_TEMPLATES[frozenset(update_fields)]
+        expression_values = {f":{k}": to_attr(v) for k, v in update_fields.items()}
+        expression_values[":updatedAt"] = to_attr(updated_at)
 
-        table.update_item(
-            Key={"email": current_email},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_values
-        )
-        return respond(200, {"message": f"User with email '{current_email}' updated successfully.", "user": item})
+        try:
+            result = ddb.update_item(
+                TableName=TABLE_NAME,
+                Key={"email": {"S": current_email}},
+                UpdateExpression=update_expression,
+                ExpressionAttributeNames=expression_names,
+                ExpressionAttributeValues=expression_values,
+                ConditionExpression="attribute_exists(email)",
+                ReturnValues="ALL_NEW"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return respond(404, {"error": f"User with email '{current_email}' not found."})
+        return respond(200, {
+            "message": f"User with email '{current_email}' updated successfully.",
+            "user": from_item(result["Attributes"])
+        })
 
-    except Exception as e:
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB error: {str(e)}"})
 
 def delete_user(event):
     params = event.get("queryStringParameters", {})
-    email = params.get("email", "").strip().lower()
+    email = norm_email(params.get("email"))
 
     if not email:
         return respond(400, {"error": "Missing 'email' in query params."})
 
     try:
-        table.delete_item(Key={"email": email})
+        ddb.delete_item(TableName=TABLE_NAME, Key={"email": {"S": email}})
         return respond(200, {"message": f"User with email '{email}' deleted successfully."})
-    except Exception as e:
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB error: {str(e)}"})
 
 def purge_users():
     try:
-        scan = table.scan()
-        with table.batch_writer() as batch:
-            for each in scan["Items"]:
-                batch.delete_item(Key={"email": each["email"]})
-        return respond(200, {"message": "All users deleted successfully."})
-    except Exception as e:
+        # Each segment gets its own worker and batch writer; the low-level client is thread-safe
+        with ThreadPoolExecutor(max_workers=PURGE_SEGMENTS) as pool:
+            deleted = sum(pool.map(purge_segment, range(PURGE_SEGMENTS)))
+        return respond(200, {"message": "All users deleted successfully.", "deleted": deleted})
+    except BotoCoreError as e:
         return respond(500, {"error": f"DynamoDB error: {str(e)}"})
 
-def respond(status, body):
-    def decimal_default(obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        raise TypeError
+def purge_segment(segment):
+    scan_args = {
+        "TableName": TABLE_NAME,
+        "Segment": segment,
+        "TotalSegments": PURGE_SEGMENTS,
+        "ProjectionExpression": "email",
+        "ConsistentRead": False,
+    }
+    deleted = 0
+    with BatchWriter(TABLE_NAME, ddb) as batch:
+        while True:
+            scan = ddb.scan(**scan_args)
+            for each in scan.get("Items", []):
+                batch.delete_item(Key={"email": each["email"]})
+                deleted += 1
+            if "LastEvaluatedKey" not in scan:
+                break
+            scan_args["ExclusiveStartKey"] = scan["LastEvaluatedKey"]
+    return deleted
+
+def projection(fields_param):
+    # Placeholders keep reserved words safe; only known attributes may be requested
+    fields = [f.strip() for f in fields_param.split(",") if f.strip()] if fields_param else list(LIST_FIELDS)
+    if not fields:
+        raise ValueError("no fields requested")
+    unknown = [f for f in fields if f not in _LISTABLE_FIELDS]
+    if unknown:
+        raise ValueError(f"unsupported fields {unknown}")
+    names = {f"#p{i}": f for i, f in enumerate(fields)}
+    return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+def client_error_response(e):
+    code = e.response.get("Error", {}).get("Code", "")
+    status = _CLIENT_ERROR_STATUS.get(code, 500)
+    if code == "ResourceNotFoundException":
+        return respond(500, {"error": f"DynamoDB table '{TABLE_NAME}' not found or not active.", "code": code})
+    message = e.response.get("Error", {}).get("Message", "")
+    if status == 503:
+        # Throttled even after botocore's adaptive retries; tell the caller when to come back
+        return respond(503, {"error": f"DynamoDB throttled the request: {message}", "code": code},
+                       headers={"Retry-After": RETRY_AFTER_SECONDS})
+    return respond(status, {"error": f"DynamoDB error: {message}", "code": code})
+
+def norm_email(value):
+    # str.lower() already takes CPython's ASCII fast path, so no translate table is needed
+    return value.strip().lower() if isinstance(value, str) else ""
+
+# Opaque pagination cursor: the raw LastEvaluatedKey is already JSON-safe
+def encode_token(last_key):
+    if not last_key:
+        return None
+    return base64.urlsafe_b64encode(orjson.dumps(last_key)).decode()
+
+def decode_token(token):
+    try:
+        return orjson.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("malformed nextToken") from e
+
+# Minimal AttributeValue (de)serialisation — the User schema only uses S, N and BOOL
+def to_attr(value):
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+    return {"S": str(value)}
+
+def from_attr(attr):
+    if "S" in attr:
+        return attr["S"]
+    if "N" in attr:
+        number = attr["N"]
+        return float(number) if "." in number or "e" in number.lower() else int(number)
+    if "BOOL" in attr:
+        return attr["BOOL"]
+    if "NULL" in attr:
+        return None
+    raise TypeError(f"Unsupported DynamoDB attribute type: {list(attr)}")
+
+def to_item(record):
+    return {k: to_attr(v) for k, v in record.items()}
+
+def from_item(item):
+    return {k: from_attr(v) for k, v in item.items()}
+
+_HEADERS = {
+    "Content-Type": "application/json",
+    "Access-Control-Allow-Origin": "*"
+}
 
+def respond(status, body, headers=None):
     return {
         "statusCode": status,
-        "headers": {
-            "Content-Type": "application/json",
-            "Access-Control-Allow-Origin": "*"
-        },
-        "body": json.dumps(body, default=decimal_default)
+        "headers": {**_HEADERS, **headers} if headers else _HEADERS,
+        # orjson output is already compact; API Gateway needs a str body
+        "body": orjson.dumps(body).decode()
     }
\ No newline at end of file
@@ -16,6 +16,16 @@ if [ ! -f "$SOURCE_FILE" ]; then
   exit 2
 fi
 
+# --- Optional dependencies, installed only for builds that enable the feature ---
+OPTIONAL_INSTALL="true"
+if [ "$WITH_SEMANTIC_CACHE" = "1" ]; then
+  OPTIONAL_INSTALL="$OPTIONAL_INSTALL && pip install --platform manylinux2014_x86_64 --target=package --implementation cp --python-version 3.12 --only-binary=:all: -r requirements-semantic.txt"
+fi
+if [ "$WITH_DAX" = "1" ]; then
+  # amazon-dax-client has no wheel set that resolves under --platform/--only-binary; it is pure Python
+  OPTIONAL_INSTALL="$OPTIONAL_INSTALL && pip install --target=package -r requirements-dax.txt"
+fi
+
 # --- Clean previous build ---
 rm -rf python package lambda.zip
 
@@ -32,6 +42,7 @@ docker run --rm -v "$PWD":/var/task -w /var/task amazonlinux:2023 /bin/bash -c "
     --python-version 3.12 \
     --only-binary=:all: \
     -r requirements.txt &&
+  $OPTIONAL_INSTALL &&
   mkdir -p python &&
   cp -r package/* python/
 "
@@ -39,6 +50,11 @@ docker run --rm -v "$PWD":/var/task -w /var/task amazonlinux:2023 /bin/bash -c "
 # --- Copy and rename handler file ---
 cp "$SOURCE_FILE" python/lambda_function.py
 
+# --- Ship the shared GPT system prompt next to the handler ---
+if [ -f "$HANDLER_DIR/system_prompt.txt" ]; then
+  cp "$HANDLER_DIR/system_prompt.txt" python/system_prompt.txt
+fi
+
 # --- Zip it up for AWS ---
 cd python
 zip -r9 ../lambda.zip .
@@ -0,0 +1,44 @@
+# One-off backfill: tag GPT_Transactions records written before the gpt-by-createdAt index
+# with entity_type so `mode=list` can see them. Safe to re-run; tagged records are skipped.
+#
+#   GPT_TABLE=GPT_Transactions python scripts/backfill_gpt_entity_type.py
+
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+ENTITY_TYPE = "GPT"
+
+table = boto3.resource("dynamodb").Table(os.environ.get("GPT_TABLE", "GPT_Transactions"))
+
+
+def backfill():
+    scan_args = {
+        "ProjectionExpression": "GPT",
+        "FilterExpression": "attribute_not_exists(entity_type)",
+    }
+    updated = 0
+    while True:
+        scan = table.scan(**scan_args)
+        for item in scan.get("Items", []):
+            try:
+                # Old records may lack createdAt; 0 sorts them last, as the old Scan listing did
+                table.update_item(
+                    Key={"GPT": item["GPT"]},
+                    UpdateExpression="SET entity_type = :t, createdAt = if_not_exists(createdAt, :zero)",
+                    ExpressionAttributeValues={":t": ENTITY_TYPE, ":zero": 0},
+                    ConditionExpression="attribute_exists(GPT)"
+                )
+                updated += 1
+            except ClientError as e:
+                # Purged between the scan and the update; nothing to tag
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        if "LastEvaluatedKey" not in scan:
+            break
+        scan_args["ExclusiveStartKey"] = scan["LastEvaluatedKey"]
+    return updated
+
+
+if __name__ == "__main__":
+    print(f"✅ Tagged {backfill()} GPT record(s) with entity_type '{ENTITY_TYPE}'")